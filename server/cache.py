@@ -1,36 +1,131 @@
+
 # cache.py
-import time, hashlib
+import os, re, time, atexit, sqlite3, threading
+from collections import OrderedDict
+
+from .logs import log
 
 # Tiempo que guardamos cada respuesta (1 hora)
 CACHE_TTL = 60 * 60
 
-# Aquí está la caja (un diccionario de Python en memoria)
-_cache = {}
+# Máximo de respuestas en la caja; al pasarnos sacamos la más vieja
+CACHE_MAX = 4096
+
+# Segunda caja en disco (SQLite) para no perder respuestas en cada deploy.
+# Vacío = solo memoria. Si la ruta no existe, seguimos solo en memoria.
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "/var/data/cache.sqlite")
+
+# Espera máxima (s) por el candado de escritura de SQLite. Cada worker tiene su
+# conexión y la espera bloquea el event loop: mejor perder una escritura que esperar
+_DB_TIMEOUT = 0.5
+
+# Cada cuántas escrituras borramos del disco las filas ya caducadas
+_DB_PURGE_EVERY = 256
+
+# Aquí está la caja (diccionario ordenado en memoria: lo más usado queda al final)
+_cache: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+_lock = threading.Lock()
+
+# Cualquier racha de espacios/tabs/saltos de línea
+_WS_RE = re.compile(r"\s+")
+
+def _open_db(path: str):
+    """Abre (o crea) la base SQLite; None si no se puede."""
+    if not path:
+        return None
+    try:
+        # Autocommit: cada escritura se confirma al momento y no deja una
+        # transacción abierta que bloquee a los otros workers
+        db = sqlite3.connect(path, timeout=_DB_TIMEOUT, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS kv(k TEXT PRIMARY KEY, exp REAL, v TEXT) WITHOUT ROWID")
+        db.execute("CREATE INDEX IF NOT EXISTS kv_exp ON kv(exp)")
+        _db_purge(db)
+        return db
+    except sqlite3.Error as e:
+        log.warning("⚠️ Cache en disco desactivada (%s): %s", path, e)
+        return None
+
+def _db_purge(db) -> None:
+    """Borra las filas caducadas (si no, el archivo crece con cada pregunta nueva)."""
+    try:
+        db.execute("DELETE FROM kv WHERE exp < ?", (time.time(),))
+    except sqlite3.Error as e:
+        log.warning("Cache en disco (limpieza) falló: %s", e)
+
+_db = _open_db(CACHE_DB_PATH)
+_db_writes = 0
+if _db is not None:
+    atexit.register(_db.close)
 
 def _normalize(text: str) -> str:
     """Convierte la pregunta en una forma simple para comparar mejor."""
-    return " ".join(text.lower().strip().split())
+    t = text.lower().strip()
+    # Caso común: texto ASCII con espacios simples, no hay nada que colapsar
+    if t.isascii() and t.isprintable() and "  " not in t:
+        return t
+    return _WS_RE.sub(" ", t)
 
 def _key(pregunta: str, lang: str) -> str:
     """Crea una llave única con pregunta+idioma."""
-    base = f"{lang}|{_normalize(pregunta)}"
-    return hashlib.sha256(base.encode()).hexdigest()
+    # \x1f (separador de unidad) no aparece en texto normal: no hay choques
+    return f"{lang}\x1f{_normalize(pregunta)}"
 
-def get_from_cache(pregunta: str, lang: str):
-    """Busca si ya tenemos la respuesta en la caja."""
-    k = _key(pregunta, lang)
-    item = _cache.get(k)
-    if not item:
+def _db_get(k: str):
+    """Busca en disco; si sigue vigente la sube a la caja en memoria."""
+    try:
+        row = _db.execute("SELECT exp, v FROM kv WHERE k=?", (k,)).fetchone()
+    except sqlite3.Error as e:
+        log.warning("Cache en disco (lectura) falló: %s", e)
+        return None
+    if not row:
         return None
-    exp, val = item
-    if exp < time.time():
-        # ya caducó
-        _cache.pop(k, None)
+    # En disco la caducidad va en hora real: el reloj monotónico se reinicia con el proceso
+    exp_wall, val = row
+    left = exp_wall - time.time()
+    if left <= 0:
         return None
+    _cache[k] = (time.monotonic() + left, val)
+    if len(_cache) > CACHE_MAX:
+        _cache.popitem(last=False)
     return val
 
+def _db_put(k: str, respuesta: str):
+    """Escribe en disco (WAL + synchronous=NORMAL: confirmar cada escritura es barato)."""
+    global _db_writes
+    try:
+        _db.execute("INSERT OR REPLACE INTO kv VALUES(?,?,?)", (k, time.time() + CACHE_TTL, respuesta))
+    except sqlite3.Error as e:
+        log.warning("Cache en disco (escritura) falló: %s", e)
+        return
+    _db_writes += 1
+    if _db_writes % _DB_PURGE_EVERY == 0:
+        _db_purge(_db)
+
+def get_from_cache(pregunta: str, lang: str):
+    """Busca si ya tenemos la respuesta en la caja."""
+    k = _key(pregunta, lang)
+    with _lock:
+        item = _cache.get(k)
+        if not item:
+            return _db_get(k) if _db is not None else None
+        exp, val = item
+        if exp < time.monotonic():
+            # ya caducó
+            del _cache[k]
+            return None
+        _cache.move_to_end(k)
+        return val
+
 def save_to_cache(pregunta: str, lang: str, respuesta: str):
     """Guarda una respuesta nueva en la caja."""
     k = _key(pregunta, lang)
-    exp = time.time() + CACHE_TTL
-    _cache[k] = (exp, respuesta)
+    exp = time.monotonic() + CACHE_TTL
+    with _lock:
+        _cache[k] = (exp, respuesta)
+        _cache.move_to_end(k)
+        if len(_cache) > CACHE_MAX:
+            _cache.popitem(last=False)
+        if _db is not None:
+            _db_put(k, respuesta)
@@ -0,0 +1,25 @@
+
+# logs.py
+# Logger compartido: los handlers solo encolan el registro y un hilo aparte
+# formatea y escribe a stderr (la petición no espera al I/O de la consola).
+import os, sys, queue, atexit, logging
+from logging.handlers import QueueHandler, QueueListener
+
+# INFO en producción; DEBUG muestra además los payloads del webhook
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+
+_stream = logging.StreamHandler(sys.stderr)
+_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+log = logging.getLogger("dental")
+log.setLevel(LOG_LEVEL)
+log.addHandler(QueueHandler(_queue))
+# No duplicar en el logger raíz (uvicorn configura el suyo)
+log.propagate = False
+
+_listener = QueueListener(_queue, _stream, respect_handler_level=True)
+_listener.start()
+# Al apagar vaciamos la cola antes de salir
+atexit.register(_listener.stop)
@@ -1,30 +1,51 @@
 # --- IMPORTS ---
 import os
 import re
-import time
-import json
-import base64
+import asyncio
+import io
+import logging
+import gzip
 import mimetypes
-import pathlib
+import random
+import secrets
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from datetime import datetime
+from functools import lru_cache
 from typing import Optional
 
-import requests
-from fastapi import FastAPI, HTTPException, Request
+import httpx
+import orjson
+from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+from .cache import get_from_cache, save_to_cache
+from .logs import log
+from .ratelimit import AsyncRateLimiter
+from .semantic_cache import SEMANTIC_CACHE, SEMANTIC_MODEL, semantic_get, semantic_put
+
+# Importación condicional para detección de idiomas.
+# Preferimos lingua (nativo, en Rust); langdetect queda como respaldo.
+try:
+    from lingua import Language, LanguageDetectorBuilder
+    LINGUA_AVAILABLE = True
+except ImportError:
+    LINGUA_AVAILABLE = False
 
-# Importación condicional para detección de idiomas
 try:
     from langdetect import detect, DetectorFactory, LangDetectException
+    from langdetect import detector_factory as _langdetect_factory
     # Para mayor consistencia en la detección
     DetectorFactory.seed = 0
     LANGDETECT_AVAILABLE = True
 except ImportError:
     LANGDETECT_AVAILABLE = False
-    print("⚠️ langdetect no disponible, usando detección heurística")
+    if not LINGUA_AVAILABLE:
+        log.warning("⚠️ lingua/langdetect no disponibles, usando detección heurística")
 
 # -------------------------------------------------------
 # CONFIGURACIÓN
@@ -33,9 +54,27 @@ ROOT_PATH = os.environ.get("ROOT_PATH", "")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 OPENAI_TEMP = float(os.getenv("OPENAI_TEMP", "0.2"))
+# Re-traducir la respuesta si no salió en el idioma pedido (segunda llamada al modelo).
+# Apagado por defecto: el prompt de sistema ya fuerza el idioma
+TRANSLATION_FALLBACK = os.getenv("TRANSLATION_FALLBACK", "0") == "1"
+# Reintentos del SDK de OpenAI ante 429/5xx/timeouts (backoff exponencial con jitter)
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+# Límites de la cuenta de OpenAI por minuto (0 = sin límite). Se reparten entre
+# los workers de uvicorn (WEB_CONCURRENCY) porque cada uno lleva su propia cuenta
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "0"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "0"))
+# Workers de uvicorn (el Procfile usa el mismo valor). 1 por defecto: la detección
+# de reintentos de Meta (_SEEN_IDS), el idioma por usuario y la caché en memoria
+# son por proceso. Cada worker carga además lingua y pesa ~340 MB de RSS tras
+# arrancar: subirlo solo con memoria para WEB_CONCURRENCY × eso
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+# Llamadas de chat a OpenAI en vuelo al mismo tiempo
+OPENAI_MAX_CONCURRENCY = max(1, int(os.getenv("OPENAI_MAX_CONCURRENCY", "8")))
 WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN", "")
 WHATSAPP_PHONE_ID = os.getenv("WHATSAPP_PHONE_ID", "")
 META_VERIFY_TOKEN = os.getenv("META_VERIFY_TOKEN", "nochgpt-verify-123")
+# Comprimir con gzip los envíos grandes a WhatsApp (menos bytes de salida)
+WA_GZIP = os.getenv("WA_GZIP", "0") == "1"
 # 📘 Agregamos aquí la variable del servicio de Wikipedia
 
 WIKIPEDIA_TOOL_URL = os.getenv("WIKIPEDIA_TOOL_URL", "https://wikipedia-rag-tool.onrender.com")
@@ -45,12 +84,29 @@ SHEETS_WEBHOOK_URL = (
     os.getenv("SHEETS_WEBHOOK_URL", "").strip() or 
     os.getenv("SHEET_WEBHOOK_URL", "").strip()
 )
+# Tickets por POST a Sheets. 1 = un ticket por POST (formato actual del Apps Script);
+# >1 agrupa hasta N tickets en {"rows": [...]} (el Apps Script debe aceptar ese formato)
+SHEETS_BATCH_MAX = max(1, int(os.getenv("SHEETS_BATCH_MAX", "1")))
+# Espera máxima (ms) para completar un lote antes de enviarlo
+SHEETS_FLUSH_MS = int(os.getenv("SHEETS_FLUSH_MS", "500"))
+# Token para endpoints de administración (vacío = deshabilitados)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "").strip()
 
 # -------------------------------------------------------
 # CONSTANTES
 # -------------------------------------------------------
 FB_API = "https://graph.facebook.com/v20.0"
 
+# Cabeceras y URL de WhatsApp: se arman una sola vez al arrancar
+_WA_MESSAGES_URL = f"{FB_API}/{WHATSAPP_PHONE_ID}/messages"
+_WA_AUTH_HEADERS = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
+_JSON_HEADERS = {"Content-Type": "application/json"}
+_WA_JSON_HEADERS = {**_WA_AUTH_HEADERS, **_JSON_HEADERS}
+_WA_GZIP_HEADERS = {**_WA_JSON_HEADERS, "Content-Encoding": "gzip"}
+
+# Solo vale la pena comprimir cuerpos de más de 1 KB
+_GZIP_MIN_BYTES = 1024
+
 SYSTEM_PROMPT = """You are NochGPT, a helpful dental laboratory assistant.
 - Focus on dental topics (prosthetics, implants, zirconia, CAD/CAM, workflows, materials, sintering, etc.).
 - Be concise, practical, and provide ranges (e.g., temperatures or times) when relevant.
@@ -72,27 +128,210 @@ LANG_NAME = {
     "ko": "Korean"      # NUEVO
 }
 
-# Palabras clave para detección de idioma
-_ES_WORDS = {
+def _lang_suffix(code: str) -> str:
+    # Instrucción estricta: el idioma se fija en la primera llamada y no hace falta re-traducir
+    name = LANG_NAME.get(code, code)
+    return (
+        f"\nReply ONLY in {name} (language code: {code})."
+        f"\nThe first word of your reply MUST already be in {name}, even if the question"
+        f" mixes languages or quotes text in another language."
+    )
+
+# Prompt de sistema completo por idioma, armado una sola vez
+_SYSTEM_PROMPT_BY_LANG = {code: SYSTEM_PROMPT + _lang_suffix(code) for code in LANG_NAME}
+
+def _system_prompt(lang_hint: Optional[str]) -> str:
+    """Prompt de sistema para el idioma pedido (sin idioma: el prompt base)."""
+    if not lang_hint:
+        return SYSTEM_PROMPT
+    return _SYSTEM_PROMPT_BY_LANG.get(lang_hint) or SYSTEM_PROMPT + _lang_suffix(lang_hint)
+
+# Códigos de langdetect -> nuestros códigos
+_LANGDETECT_MAP = {
+    'es': 'es',
+    'en': 'en',
+    'pt': 'pt',
+    'fr': 'fr',
+    'ar': 'ar',
+    'hi': 'hi',
+    'zh': 'zh', 'zh-cn': 'zh', 'zh-tw': 'zh',
+    'ru': 'ru',
+    'ja': 'ja',
+    'ko': 'ko',
+}
+
+# lingua solo tiene que distinguir idiomas de escritura latina:
+# árabe, hindi, chino, japonés, coreano y ruso los resuelve _script_lang
+if LINGUA_AVAILABLE:
+    _LINGUA_CODES = {
+        Language.SPANISH: "es",
+        Language.ENGLISH: "en",
+        Language.PORTUGUESE: "pt",
+        Language.FRENCH: "fr",
+    }
+    # Otros idiomas latinos frecuentes que no atendemos: se reconocen para que un
+    # mensaje en italiano o alemán no se fuerce a pt/fr, y se responden en inglés.
+    # Cada uno suma ~25 MB al worker; todos los latinos serían ~900 MB
+    _LINGUA_OTHERS = (
+        Language.GERMAN, Language.ITALIAN, Language.DUTCH, Language.CATALAN, Language.ROMANIAN,
+    )
+    # Modelos cargados al arrancar el worker: si no, el primer mensaje paga ~0.5 s de carga
+    _LINGUA = (
+        LanguageDetectorBuilder.from_languages(*_LINGUA_CODES, *_LINGUA_OTHERS)
+        .with_preloaded_language_models()
+        .build()
+    )
+else:
+    _LINGUA = None
+
+# Mismo criterio para langdetect (solo se usa sin lingua): cargar los 55 perfiles
+# cuesta memoria y tiempo por consulta. Basta con los 4 latinos que atendemos y los
+# mismos otros latinos de lingua (se mapean a "en" en _LANGDETECT_MAP)
+_LANGDETECT_PROFILES = ("es", "en", "pt", "fr", "de", "it", "nl", "ca", "ro")
+
+def _load_langdetect_profiles() -> None:
+    """Deja cargados en langdetect solo los perfiles de _LANGDETECT_PROFILES."""
+    profiles = []
+    for code in _LANGDETECT_PROFILES:
+        with open(os.path.join(_langdetect_factory.PROFILES_DIRECTORY, code), encoding="utf-8") as f:
+            profiles.append(f.read())
+    factory = DetectorFactory()
+    factory.load_json_profile(profiles)
+    # detect() usa esta fábrica en lugar de cargar el directorio completo
+    _langdetect_factory._factory = factory
+
+if LANGDETECT_AVAILABLE and not LINGUA_AVAILABLE:
+    _load_langdetect_profiles()
+
+# Mensaje al usuario cuando falla el modelo
+_ERROR_MSGS = {
+    "es": "Lo siento, hubo un problema con el modelo. Intenta de nuevo.",
+    "en": "Sorry, there was a problem with the model. Please try again.",
+    "pt": "Desculpe, houve um problema com o modelo. Tente novamente.",
+    "fr": "Désolé, il y a eu un problème avec le modèle. Veuillez réessayer.",
+    "ar": "عذرًا، كانت هناك مشكلة في النموذج. يرجى المحاولة مرة أخرى.",
+    "hi": "क्षमा करें, मॉडल में कोई समस्या थी। कृपया पुनः प्रयास करें।",
+    "zh": "抱歉，模型出现了问题。请再试一次。",
+    "ru": "Извините, возникла проблема с моделью. Пожалуйста, попробуйте еще раз.",
+    "ja": "申し訳ありませんが、モデルに問題が発生しました。もう一度お試しください。",
+    "ko": "죄송합니다. 모델에 문제가 발생했습니다. 다시 시도해 주세요.",
+}
+
+# Palabras clave para detección de idioma (solo escritura latina:
+# árabe, hindi, chino y ruso los resuelve _script_lang)
+_ES_WORDS = frozenset({
     "hola", "que", "como", "porque", "para", "gracias", "buenos", "buenas", "usted", "ustedes",
     "dentadura", "protesis", "implante", "zirconia", "carillas", "corona", "acrilico", "tiempos",
     "cuanto", "precio", "coste", "costos", "ayuda", "diente", "piezas", "laboratorio", "materiales",
     "cementacion", "sinterizado", "ajuste", "oclusion", "metal", "ceramica", "encias", "paciente",
-}
-_PT_MARKERS = {"ola", "olá", "porque", "você", "vocês", "dentes", "prótese", "zirconia", "tempo"}
-_FR_MARKERS = {"bonjour", "pourquoi", "combien", "prothèse", "implants", "zircone", "temps"}
-_AR_MARKERS = {"مرحبا", "كيف", "لماذا", "شكرا", "اسنان", "طقم", "زركونيا"}
-_HI_MARKERS = {"नमस्ते", "कैसे", "क्यों", "धन्यवाद", "दांत", "मुकुट", "जिरकोनिया"}
-_ZH_MARKERS = {"你好", "怎么样", "为什么", "谢谢", "牙齿", "牙冠", "氧化锆"}
-_RU_MARKERS = {"привет", "как", "почему", "спасибо", "зуб", "коронка", "цирконий"}
+})
+_PT_MARKERS = frozenset({"ola", "olá", "porque", "você", "vocês", "dentes", "prótese", "zirconia", "tempo"})
+_FR_MARKERS = frozenset({"bonjour", "pourquoi", "combien", "prothèse", "implants", "zircone", "temps"})
+
+# Índice palabra -> idiomas en que cuenta (una sola búsqueda por palabra)
+_WORD_LANGS: dict[str, tuple[str, ...]] = {}
+for _lang, _words in (("es", _ES_WORDS), ("pt", _PT_MARKERS), ("fr", _FR_MARKERS)):
+    for _w in _words:
+        _WORD_LANGS[_w] = _WORD_LANGS.get(_w, ()) + (_lang,)
+del _lang, _words, _w
+
+# Respuestas más cortas no se re-traducen ("OK", "Sí"): la detección no es fiable
+_TRANSLATE_MIN_CHARS = 40
+
+# Idiomas que se reconocen solo por su escritura (sin modelo)
+_SCRIPT_LANGS = frozenset({"ru", "ar", "hi", "zh", "ja", "ko"})
+
+# Preguntas más largas no se guardan en la caché de respuestas
+_CACHE_MAX_QUESTION = 400
+
+# Datos personales (teléfonos de 10+ dígitos, correos): esas preguntas no se guardan
+# ni se sirven desde la caché. Cifras y rangos (1450-1550 °C, 8 h) sí se permiten
+_RE_PERSONAL = re.compile(r"(?:\d[ \-().]{0,2}){10,}|[\w.+-]+@[\w-]+\.[\w.]+")
+
+# La señal de idioma se satura rápido: solo analizamos el inicio del texto
+# (transcripciones largas no disparan el costo de detección)
+_DETECT_MAX_CHARS = 200
+
+# Rangos Unicode por escritura no latina: (inicio, fin, idioma)
+_SCRIPT_RANGES = (
+    (0x0400, 0x04FF, "ru"),   # Cirílico
+    (0x0600, 0x06FF, "ar"),   # Árabe
+    (0x0900, 0x097F, "hi"),   # Devanagari
+    (0x3040, 0x30FF, "ja"),   # Hiragana / Katakana
+    (0x31F0, 0x31FF, "ja"),   # Katakana (ext.)
+    (0x4E00, 0x9FFF, "zh"),   # CJK
+    (0xAC00, 0xD7AF, "ko"),   # Hangul
+    (0xFF66, 0xFF9D, "ja"),   # Katakana de ancho medio
+)
+
+# Tabla del plano básico Unicode: código -> índice en _SCRIPT_CODES (0 = latino/otro).
+# Clasificar un carácter es un solo acceso por índice, sin recorrer los rangos
+_SCRIPT_CODES = ("",) + tuple(dict.fromkeys(lang for _, _, lang in _SCRIPT_RANGES))
+_SCRIPT_TABLE = bytearray(0x10000)
+for _lo, _hi, _lang in _SCRIPT_RANGES:
+    _SCRIPT_TABLE[_lo:_hi + 1] = bytes([_SCRIPT_CODES.index(_lang)]) * (_hi - _lo + 1)
+_SCRIPT_TABLE = bytes(_SCRIPT_TABLE)
+del _lo, _hi, _lang
 
-# Historial simple en memoria
-HISTORY_LOG: list[str] = []
+# Patrones compilados una sola vez para la detección de respaldo
+_RE_KANA = re.compile(r"[\u3040-\u30FF\u31F0-\u31FF\uFF66-\uFF9D]")
+# Diacríticos por idioma: conjuntos en vez de regex (basta una prueba de pertenencia)
+_ES_CHARS = frozenset("áéíóúñ¿¡")
+_PT_CHARS = frozenset("ãõáéíóúç")
+_FR_CHARS = frozenset("àâçéèêëîïôùûüÿœ")
+_RE_TOKENS = re.compile(r"[a-záéíóúñçàâêîôûüœ]+")
+
+# Último idioma detectado por número de WhatsApp (acotado: se descarta el más viejo)
+_LANG_BY_USER_MAX = 4096
+_LANG_BY_USER: "OrderedDict[str, str]" = OrderedDict()
+
+# IDs de mensajes de WhatsApp ya atendidos: Meta reintenta webhooks y no queremos
+# responder (ni pagar OpenAI) dos veces. Se olvidan tras _SEEN_TTL segundos
+_SEEN_MAX = 10_000
+_SEEN_TTL = 600
+_SEEN_IDS: "OrderedDict[str, float]" = OrderedDict()
+
+# Historial simple en memoria, uno por worker (las entradas más viejas se descartan solas)
+MAX_HISTORY = 500
+HISTORY_LOG: deque[str] = deque(maxlen=MAX_HISTORY)
 
 # -------------------------------------------------------
 # INICIALIZACIÓN DE CLIENTES
 # -------------------------------------------------------
-app = FastAPI(title="Dental-LLM API", root_path=ROOT_PATH)
+# Cliente HTTP asíncrono compartido (HTTP/2 + keep-alive con Meta y Sheets).
+# Se crea al arrancar cada worker y se cierra al apagarlo.
+_HTTP: Optional[httpx.AsyncClient] = None
+
+# Cola de tickets para Sheets y tarea que la vacía (ver _sheets_flusher)
+_TICKET_Q: Optional[asyncio.Queue] = None
+_TICKET_Q_MAX = 1000
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _HTTP, _TICKET_Q
+    _HTTP = httpx.AsyncClient(
+        http2=True,
+        timeout=20,
+        limits=httpx.Limits(max_keepalive_connections=32),
+    )
+    _TICKET_Q = asyncio.Queue(maxsize=_TICKET_Q_MAX)
+    flusher = asyncio.create_task(_sheets_flusher(_TICKET_Q))
+    try:
+        yield
+    finally:
+        # Detener con señal (no cancel): el lote que el flusher ya sacó de la cola también se envía
+        await _TICKET_Q.put(None)
+        await flusher
+        await _drain_tickets(_TICKET_Q)
+        _TICKET_Q = None
+        await _HTTP.aclose()
+
+class ORJSONResponse(JSONResponse):
+    """Respuesta JSON serializada con orjson (más rápido que json de la stdlib)."""
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+app = FastAPI(title="Dental-LLM API", root_path=ROOT_PATH, default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -103,38 +342,64 @@ app.add_middleware(
 )
 
 if not OPENAI_API_KEY:
-    print("⚠️ Falta OPENAI_API_KEY")
+    log.warning("⚠️ Falta OPENAI_API_KEY")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Pool propio hacia api.openai.com: conexiones TLS reutilizadas entre llamadas
+# (DefaultAsyncHttpxClient conserva los timeouts/redirects por defecto del SDK)
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    max_retries=OPENAI_MAX_RETRIES,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    ),
+)
 
 if not SHEETS_WEBHOOK_URL:
-    print("⚠️ Falta SHEET_WEBHOOK / SHEETS_WEBHOOK_URL en variables de entorno")
+    log.warning("⚠️ Falta SHEET_WEBHOOK / SHEETS_WEBHOOK_URL en variables de entorno")
 
 # -------------------------------------------------------
 # UTILIDADES DE IDIOMA
 # -------------------------------------------------------
+def _script_lang(t: str) -> Optional[str]:
+    """Idioma por escritura no latina en un solo recorrido (sale en el primer acierto)."""
+    if t.isascii():
+        return None
+    for ch in t:
+        c = ord(ch)
+        if c < 0x0400 or c > 0xFFFF:
+            continue
+        k = _SCRIPT_TABLE[c]
+        if k:
+            lang = _SCRIPT_CODES[k]
+            # Los kanji también son CJK: si hay kana, es japonés
+            if lang == "zh" and _RE_KANA.search(t):
+                return "ja"
+            return lang
+    return None
+
 def detect_lang(text: str) -> str:
-    """Detecta el idioma del texto usando langdetect o heurística (robusta para ja/ko/zh/hi/etc.)."""
-    t = (text or "").strip()
+    """Detecta el idioma del texto usando lingua, langdetect o heurística (robusta para ja/ko/zh/hi/etc.)."""
+    return _detect_lang_cached((text or "").strip()[:_DETECT_MAX_CHARS])
+
+@lru_cache(maxsize=4096)
+def _detect_lang_cached(t: str) -> str:
+    # Saludos y frases repetidas ("hola", "gracias") no vuelven a pasar por el detector
     if not t:
         return "en"
 
-    if LANGDETECT_AVAILABLE:
+    # Escrituras no latinas se resuelven sin modelo
+    script = _script_lang(t)
+    if script:
+        return script
+
+    if _LINGUA is not None:
+        found = _LINGUA.detect_language_of(t)
+        if found is not None:
+            return _LINGUA_CODES.get(found, "en")
+    elif LANGDETECT_AVAILABLE:
         try:
             detected_lang = detect(t)  # ej: 'en','es','pt','fr','ru','ar','hi','zh-cn','zh-tw','ja','ko'
-            lang_map = {
-                'es': 'es',
-                'en': 'en',
-                'pt': 'pt',
-                'fr': 'fr',
-                'ar': 'ar',
-                'hi': 'hi',
-                'zh': 'zh', 'zh-cn': 'zh', 'zh-tw': 'zh',
-                'ru': 'ru',
-                'ja': 'ja',
-                'ko': 'ko',
-            }
-            return lang_map.get(detected_lang, 'en')
+            return _LANGDETECT_MAP.get(detected_lang, 'en')
         except (LangDetectException, Exception):
             pass
 
@@ -145,121 +410,370 @@ def _fallback_detect_lang(text: str) -> str:
     t = (text or "").lower()
 
     # 1) Por script
-    if re.search(r"[\u0600-\u06FF]", t): return "ar"      # Árabe
-    if re.search(r"[\u0900-\u097F]", t): return "hi"      # Devanagari
-    if re.search(r"[\u4E00-\u9FFF]", t): return "zh"      # CJK
-    if re.search(r"[\u3040-\u309F\u30A0-\u30FF\u31F0-\u31FF\uFF66-\uFF9D]", t): return "ja"  # JP
-    if re.search(r"[\uAC00-\uD7AF]", t): return "ko"      # Hangul
-    if re.search(r"[\u0400-\u04FF]", t): return "ru"      # Cirílico
+    script = _script_lang(t)
+    if script: return script
 
     # 2) Diacríticos frecuentes
-    if re.search(r"[áéíóúñ¿¡]", t): return "es"
-    if re.search(r"[ãõáéíóúç]", t): return "pt"
-    if re.search(r"[àâçéèêëîïôùûüÿœ]", t): return "fr"
+    if not t.isascii():
+        if not _ES_CHARS.isdisjoint(t): return "es"
+        if not _PT_CHARS.isdisjoint(t): return "pt"
+        if not _FR_CHARS.isdisjoint(t): return "fr"
 
     # 3) Vocabulario dental (sin diacríticos)
-    tokens = set(re.findall(r"[a-záéíóúñçàâêîôûüœ]+", t))
-    lang_hits = {
-        "es": len(tokens & _ES_WORDS),
-        "pt": len(tokens & _PT_MARKERS),
-        "fr": len(tokens & _FR_MARKERS),
-    }
-    best_lang = max(lang_hits.items(), key=lambda x: x[1])
-    return best_lang[0] if best_lang[1] >= 2 else "en"
+    lang_hits = {"es": 0, "pt": 0, "fr": 0}
+    for tok in set(_RE_TOKENS.findall(t)):
+        for lang in _WORD_LANGS.get(tok, ()):
+            lang_hits[lang] += 1
+    best_lang = max(lang_hits, key=lang_hits.get)
+    return best_lang if lang_hits[best_lang] >= 2 else "en"
 
 # -------------------------------------------------------
 # FUNCIONES DE OPENAI
 # -------------------------------------------------------
-def call_openai(question: str, lang_hint: Optional[str] = None) -> str:
+def _cacheable(question: str) -> bool:
+    """Preguntas cortas y sin datos personales: se pueden compartir entre usuarios."""
+    return len(question) <= _CACHE_MAX_QUESTION and not _RE_PERSONAL.search(question)
+
+# Tope de chats concurrentes: evita ráfagas contra el límite de OpenAI
+# y que se abran conexiones de más cuando llegan muchos mensajes juntos
+_OPENAI_SEM = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+
+# Cupo por minuto de este worker (RPM/TPM de la cuenta repartidos entre workers)
+# (nunca por debajo de 1: un límite configurado no puede redondearse a 0 = sin límite)
+_OPENAI_LIMIT = AsyncRateLimiter(
+    max(1, OPENAI_RPM // WEB_CONCURRENCY) if OPENAI_RPM else 0,
+    max(1, OPENAI_TPM // WEB_CONCURRENCY) if OPENAI_TPM else 0,
+)
+
+# Tokens de respuesta que reservamos por llamada (la longitud real no se sabe antes)
+_EST_COMPLETION_TOKENS = 400
+
+def _est_tokens(*texts: str) -> int:
+    """Estimación gruesa de tokens de una llamada (~4 caracteres por token)."""
+    return sum(len(t) for t in texts) // 4 + _EST_COMPLETION_TOKENS
+
+class _EmbeddingBatcher:
+    """Junta textos que llegan casi a la vez y pide sus embeddings en una sola llamada."""
+
+    def __init__(self, max_items: int = 32, max_wait: float = 0.025):
+        self.max_items = max_items
+        self.max_wait = max_wait
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def embed(self, text: str) -> list[float]:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((text, fut))
+        if len(self._pending) >= self.max_items:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await fut
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list[tuple[str, asyncio.Future]]):
+        try:
+            r = await client.embeddings.create(model=SEMANTIC_MODEL, input=[t for t, _ in batch])
+            # La API devuelve un índice por entrada; no dependemos del orden
+            for d in r.data:
+                fut = batch[d.index][1]
+                if not fut.done():
+                    fut.set_result(d.embedding)
+            # Entradas que faltaron en la respuesta: sin esto su llamada esperaría para siempre
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(RuntimeError("embedding ausente en la respuesta"))
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+
+_EMBEDDER = _EmbeddingBatcher()
+
+async def call_openai(question: str, lang_hint: Optional[str] = None, use_cache: bool = True) -> str:
     """Llama al modelo forzando el idioma del usuario (incluye ja/ko) y traduce si es necesario."""
-    sys = SYSTEM_PROMPT
-    if lang_hint:
-        target_name = LANG_NAME.get(lang_hint, lang_hint)
-        sys += f"\nReply ONLY in {target_name} (language code: {lang_hint})."
+    # Preguntas frecuentes repetidas: respondemos desde la caché sin llamar al modelo
+    cacheable = use_cache and _cacheable(question)
+    if cacheable:
+        cached = get_from_cache(question, lang_hint or "")
+        if cached:
+            return cached
+
+    # Paráfrasis de preguntas ya respondidas (opcional, SEMANTIC_CACHE=1)
+    emb = None
+    if cacheable and SEMANTIC_CACHE:
+        emb = await _embed(question)
+        if emb is not None:
+            cached = semantic_get(emb, lang_hint or "")
+            if cached:
+                save_to_cache(question, lang_hint or "", cached)
+                return cached
+
+    sys = _system_prompt(lang_hint)
 
     try:
-        resp = client.chat.completions.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": sys},
-                {"role": "user", "content": question},
-            ],
-            temperature=OPENAI_TEMP,
-        )
+        await _OPENAI_LIMIT.acquire(_est_tokens(sys, question))
+        async with _OPENAI_SEM:
+            resp = await client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=[
+                    {"role": "system", "content": sys},
+                    {"role": "user", "content": question},
+                ],
+                temperature=OPENAI_TEMP,
+            )
         answer = (resp.choices[0].message.content or "").strip()
     except Exception as e:
-        print("OpenAI error:", e)
-        error_msgs = {
-            "es": "Lo siento, hubo un problema con el modelo. Intenta de nuevo.",
-            "en": "Sorry, there was a problem with the model. Please try again.",
-            "pt": "Desculpe, houve um problema com o modelo. Tente novamente.",
-            "fr": "Désolé, il y a eu un problème avec le modèle. Veuillez réessayer.",
-            "ar": "عذرًا، كانت هناك مشكلة في النموذج. يرجى المحاولة مرة أخرى.",
-            "hi": "क्षमा करें, मॉडल में कोई समस्या थी। कृपया पुनः प्रयास करें।",
-            "zh": "抱歉，模型出现了问题。请再试一次。",
-            "ru": "Извините, возникла проблема с моделью. Пожалуйста, попробуйте еще раз.",
-            "ja": "申し訳ありませんが、モデルに問題が発生しました。もう一度お試しください。",
-            "ko": "죄송합니다. 모델에 문제가 발생했습니다. 다시 시도해 주세요.",
-        }
-        return error_msgs.get(lang_hint or "", error_msgs["en"])
-
-    # Asegurar idioma de salida
-    if lang_hint:
-        detected_answer_lang = detect_lang(answer)
+        log.error("OpenAI error: %s", e)
+        return _ERROR_MSGS.get(lang_hint or "", _ERROR_MSGS["en"])
+
+    # Asegurar idioma de salida (opcional, TRANSLATION_FALLBACK=1)
+    if TRANSLATION_FALLBACK and lang_hint and len(answer) >= _TRANSLATE_MIN_CHARS:
+        if lang_hint in _SCRIPT_LANGS:
+            detected_answer_lang = _script_lang(answer[:_DETECT_MAX_CHARS])
+        else:
+            detected_answer_lang = detect_lang(answer)
         if detected_answer_lang != lang_hint:
             try:
                 target_name = LANG_NAME.get(lang_hint, lang_hint)
-                tr = client.chat.completions.create(
+                await _OPENAI_LIMIT.acquire(_est_tokens(answer))
+                async with _OPENAI_SEM:
+                    tr = await client.chat.completions.create(
+                        model=OPENAI_MODEL,
+                        messages=[
+                            {"role": "system", "content": f"Translate into {target_name}. Keep meaning and formatting."},
+                            {"role": "user", "content": answer},
+                        ],
+                        temperature=0.0,
+                    )
+                answer = (tr.choices[0].message.content or "").strip()
+            except Exception as e:
+                log.warning("Fallback traducción falló: %s", e)
+
+    if cacheable and answer:
+        save_to_cache(question, lang_hint or "", answer)
+        if emb is not None:
+            semantic_put(emb, lang_hint or "", answer)
+    return answer
+
+# Fin del stream en la cola de _pump_openai_stream
+_STREAM_END = object()
+
+async def _pump_openai_stream(sys: str, question: str, out: asyncio.Queue) -> None:
+    """Lee el stream de OpenAI hacia `out` (trozos, luego _STREAM_END o la excepción).
+
+    Esta tarea es la que ocupa el cupo de _OPENAI_SEM y lo suelta en cuanto el
+    modelo termina: un cliente SSE lento no lo retiene.
+    """
+    try:
+        await _OPENAI_LIMIT.acquire(_est_tokens(sys, question))
+        async with _OPENAI_SEM:
+            stream = await client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=[
+                    {"role": "system", "content": sys},
+                    {"role": "user", "content": question},
+                ],
+                temperature=OPENAI_TEMP,
+                stream=True,
+            )
+            async for chunk in stream:
+                piece = chunk.choices[0].delta.content if chunk.choices else None
+                if piece:
+                    out.put_nowait(piece)
+        out.put_nowait(_STREAM_END)
+    except Exception as e:
+        out.put_nowait(e)
+
+async def stream_openai(question: str, lang_hint: Optional[str] = None, use_cache: bool = True):
+    """Como call_openai, pero va entregando el texto a medida que lo genera el modelo.
+
+    Si el modelo falla a mitad de respuesta se relanza el error: el texto quedó cortado.
+    """
+    cacheable = use_cache and _cacheable(question)
+    if cacheable:
+        cached = get_from_cache(question, lang_hint or "")
+        if cached:
+            yield cached
+            return
+
+    q: asyncio.Queue = asyncio.Queue()
+    pump = asyncio.create_task(_pump_openai_stream(_system_prompt(lang_hint), question, q))
+    parts = []
+    try:
+        while True:
+            item = await q.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, Exception):
+                log.error("OpenAI error (stream): %s", item)
+                if parts:
+                    raise item
+                yield _ERROR_MSGS.get(lang_hint or "", _ERROR_MSGS["en"])
+                return
+            parts.append(item)
+            yield item
+    finally:
+        # Si el cliente se desconectó dejamos de leer del modelo
+        pump.cancel()
+
+    answer = "".join(parts).strip()
+    if cacheable and answer:
+        save_to_cache(question, lang_hint or "", answer)
+
+_BATCH_INSTRUCTIONS = (
+    "\nYou will receive several numbered questions, each tagged with a language code."
+    "\nAnswer each one independently, in the language of its code."
+    '\nReturn ONLY a JSON object keyed by question number: {"answers": {"1": "<answer 1>", "2": "<answer 2>", ...}}.'
+)
+
+async def call_openai_batch(items: list[tuple[str, str]]) -> list[str]:
+    """Responde varias preguntas (pregunta, idioma) con una sola llamada al modelo.
+
+    Solo para preguntas de un mismo remitente: todas comparten el prompt.
+    """
+    answers: list[Optional[str]] = [None] * len(items)
+    pending = []
+    for i, (q, lang) in enumerate(items):
+        cached = get_from_cache(q, lang) if _cacheable(q) else None
+        if cached:
+            answers[i] = cached
+        else:
+            pending.append(i)
+
+    if len(pending) == 1:
+        i = pending[0]
+        answers[i] = await call_openai(*items[i])
+    elif pending:
+        numbered = "\n".join(f"{n}) [{items[i][1]}] {items[i][0]}" for n, i in enumerate(pending, 1))
+        try:
+            await _OPENAI_LIMIT.acquire(_est_tokens(SYSTEM_PROMPT, numbered) + _EST_COMPLETION_TOKENS * (len(pending) - 1))
+            async with _OPENAI_SEM:
+                resp = await client.chat.completions.create(
                     model=OPENAI_MODEL,
                     messages=[
-                        {"role": "system", "content": f"Translate into {target_name}. Keep meaning and formatting."},
-                        {"role": "user", "content": answer},
+                        {"role": "system", "content": SYSTEM_PROMPT + _BATCH_INSTRUCTIONS},
+                        {"role": "user", "content": numbered},
                     ],
-                    temperature=0.0,
+                    temperature=OPENAI_TEMP,
+                    response_format={"type": "json_object"},
                 )
-                answer = (tr.choices[0].message.content or "").strip()
-            except Exception as e:
-                print("Fallback traducción falló:", e)
+            out = orjson.loads(resp.choices[0].message.content or "{}").get("answers")
+        except Exception as e:
+            log.warning("Lote a OpenAI falló, respondo una por una: %s", e)
+            out = None
 
-    return answer
+        # Cada respuesta se asigna por su número, nunca por posición
+        keys = [str(n) for n in range(1, len(pending) + 1)]
+        if (isinstance(out, dict) and sorted(out) == sorted(keys)
+                and all(isinstance(out[k], str) and out[k].strip() for k in keys)):
+            for i, k in zip(pending, keys):
+                answers[i] = out[k].strip()
+                if _cacheable(items[i][0]):
+                    save_to_cache(items[i][0], items[i][1], answers[i])
+        else:
+            # Respuesta del lote incompleta o mal formada: llamadas individuales
+            singles = await asyncio.gather(*(call_openai(*items[i]) for i in pending))
+            for i, a in zip(pending, singles):
+                answers[i] = a
+    return answers
+
+async def _embed(text: str):
+    """Vector de embeddings de la pregunta; None si falla (seguimos sin caché semántica)."""
+    try:
+        return await _EMBEDDER.embed(text)
+    except Exception as e:
+        log.warning("Embeddings fallaron: %s", e)
+        return None
 
-def transcribe_audio_with_openai(audio_path: str) -> str:
+# Tipos de audio que manda WhatsApp -> extensión que reconoce OpenAI.
+# (mimetypes da ".oga" para audio/ogg y nada para "audio/ogg; codecs=opus")
+_AUDIO_EXT = {
+    "audio/ogg": ".ogg",
+    "audio/opus": ".ogg",
+    "audio/mpeg": ".mp3",
+    "audio/mp4": ".m4a",
+    "audio/aac": ".aac",
+    "audio/amr": ".amr",
+    "audio/webm": ".webm",
+    "audio/wav": ".wav",
+    "audio/x-wav": ".wav",
+}
+
+async def transcribe_audio_with_openai(audio: bytes, mime: str = "audio/ogg") -> str:
     """Transcribe audio usando Whisper o GPT-4o-mini-transcribe"""
+    # El SDK acepta (nombre, bytes, mime); la extensión le indica el formato
+    base = mime.split(";", 1)[0].strip().lower()
+    ext = _AUDIO_EXT.get(base) or mimetypes.guess_extension(base) or ".bin"
+    upload = (f"audio{ext}", audio, mime)
     try:
-        with open(audio_path, "rb") as f:
-            tr = client.audio.transcriptions.create(model="whisper-1", file=f)
+        tr = await client.audio.transcriptions.create(model="whisper-1", file=upload)
         return (tr.text or "").strip()
     except Exception as e1:
-        print("whisper-1 falló, intento gpt-4o-mini-transcribe:", e1)
+        log.warning("whisper-1 falló, intento gpt-4o-mini-transcribe: %s", e1)
         try:
-            with open(audio_path, "rb") as f:
-                tr = client.audio.transcriptions.create(model="gpt-4o-mini-transcribe", file=f)
+            tr = await client.audio.transcriptions.create(model="gpt-4o-mini-transcribe", file=upload)
             return (tr.text or "").strip()
         except Exception as e2:
-            print("Transcripción falló:", e2)
+            log.error("Transcripción falló: %s", e2)
             return ""
 
 # -------------------------------------------------------
 # UTILIDADES DE WHATSAPP
 # -------------------------------------------------------
+# Reintentos de POST a Meta y Sheets ante fallos pasajeros
+_POST_ATTEMPTS = 3
+_POST_BACKOFF = 0.5     # segundos antes del primer reintento (luego se duplica)
+
+async def _post_with_retry(url: str, **kwargs) -> httpx.Response:
+    """POST con backoff exponencial ante 429/5xx o si no se pudo conectar.
+
+    No reintenta timeouts de lectura: el servidor pudo haber recibido el POST
+    y reintentar duplicaría el mensaje de WhatsApp o la fila en Sheets.
+    """
+    delay = _POST_BACKOFF
+    for attempt in range(1, _POST_ATTEMPTS + 1):
+        try:
+            r = await _HTTP.post(url, **kwargs)
+            if r.status_code != 429 and r.status_code < 500:
+                return r
+            if attempt == _POST_ATTEMPTS:
+                return r
+            log.warning("POST a %s -> %s, reintento %d", httpx.URL(url).host, r.status_code, attempt)
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+            if attempt == _POST_ATTEMPTS:
+                raise
+            log.warning("POST a %s sin conexión (%s), reintento %d", httpx.URL(url).host, e, attempt)
+        await asyncio.sleep(delay * (1 + random.random()))
+        delay *= 2
+
+# Caracteres que se quitan del número en una sola pasada (espacios, saltos,
+# guiones, paréntesis y puntos de formatos como "(55) 1234-5678")
+_E164_TRANS = str.maketrans("", "", " \t\r\n-().")
+
+# Los mismos números se repiten en cada respuesta de una conversación
+@lru_cache(maxsize=1024)
 def _e164_no_plus(num: str) -> str:
-    num = (num or "").strip().replace(" ", "").replace("-", "")
+    num = (num or "").strip().translate(_E164_TRANS)
     return num[1:] if num.startswith("+") else num
 
-def _wa_base_url() -> str:
-    return f"{FB_API}/{WHATSAPP_PHONE_ID}/messages"
-
-def wa_send_text(to_number: str, body: str) -> dict:
+async def wa_send_text(to_number: str, body: str) -> dict:
     """Envía un mensaje de texto por WhatsApp"""
     if not (WHATSAPP_TOKEN and WHATSAPP_PHONE_ID):
-        print("⚠️ Falta WHATSAPP_TOKEN o WHATSAPP_PHONE_ID")
+        log.warning("⚠️ Falta WHATSAPP_TOKEN o WHATSAPP_PHONE_ID")
         return {"ok": False, "error": "missing_credentials"}
 
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-        "Content-Type": "application/json",
-    }
-
     data = {
         "messaging_product": "whatsapp",
         "to": _e164_no_plus(to_number),
@@ -267,93 +781,254 @@ def wa_send_text(to_number: str, body: str) -> dict:
         "text": {"preview_url": False, "body": body[:3900]},
     }
 
+    content = orjson.dumps(data)
+    headers = _WA_JSON_HEADERS
+    if WA_GZIP and len(content) > _GZIP_MIN_BYTES:
+        # Nivel 1: casi sin costo de CPU y quita la mayor parte de lo repetido
+        content = gzip.compress(content, compresslevel=1)
+        headers = _WA_GZIP_HEADERS
+
     try:
-        r = requests.post(_wa_base_url(), headers=headers, json=data, timeout=20)
-        j = r.json() if r.headers.get("content-type", "").startswith("application/json") else {"raw": r.text}
+        r = await _post_with_retry(_WA_MESSAGES_URL, headers=headers, content=content, timeout=20)
+        j = orjson.loads(r.content) if r.headers.get("content-type", "").startswith("application/json") else {"raw": r.text}
         
-        if not r.ok:
-            print("WA send error:", j)
+        if not r.is_success:
+            log.error("WA send error: %s", j)
         
-        return {"ok": r.ok, "status": r.status_code, "resp": j}
+        return {"ok": r.is_success, "status": r.status_code, "resp": j}
     except Exception as e:
-        print("WA send exception:", e)
+        log.error("WA send exception: %s", e)
         return {"ok": False, "error": str(e)}
 
-def wa_get_media_url(media_id: str) -> str:
+async def wa_get_media_url(media_id: str) -> str:
     """Obtiene la URL de un archivo multimedia de WhatsApp"""
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
-    r = requests.get(f"{FB_API}/{media_id}", headers=headers, timeout=15)
+    r = await _HTTP.get(f"{FB_API}/{media_id}", headers=_WA_AUTH_HEADERS, timeout=15)
     r.raise_for_status()
-    return (r.json() or {}).get("url", "")
+    return (orjson.loads(r.content) or {}).get("url", "")
 
-def wa_download_media(signed_url: str, dest_prefix: str = "/tmp/wa_media/") -> tuple[str, str]:
-    """Descarga un archivo multimedia de WhatsApp"""
-    pathlib.Path(dest_prefix).mkdir(parents=True, exist_ok=True)
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}"}
-    
-    r = requests.get(signed_url, headers=headers, stream=True, timeout=30)
-    r.raise_for_status()
-    
-    mime = r.headers.get("Content-Type", "application/octet-stream")
-    ext = mimetypes.guess_extension(mime) or ".bin"
-    path = os.path.join(dest_prefix, f"{int(time.time())}{ext}")
-    
-    with open(path, "wb") as f:
-        for chunk in r.iter_content(8192):
-            if chunk:
-                f.write(chunk)
+# Trozos grandes: menos iteraciones/copias al bajar notas de voz e imágenes
+_MEDIA_CHUNK = 256 * 1024
+
+async def wa_download_media(signed_url: str) -> tuple[bytes, str]:
+    """Descarga un archivo multimedia de WhatsApp a memoria (sin pasar por disco)"""
+    buf = io.BytesIO()
+    async with _HTTP.stream("GET", signed_url, headers=_WA_AUTH_HEADERS, timeout=30) as r:
+        r.raise_for_status()
+        mime = r.headers.get("Content-Type", "application/octet-stream")
+        async for chunk in r.aiter_bytes(_MEDIA_CHUNK):
+            buf.write(chunk)
     
-    return path, mime
+    return buf.getvalue(), mime
 
 # -------------------------------------------------------
 # UTILIDADES DE GOOGLE SHEETS
 # -------------------------------------------------------
-def send_ticket_to_sheet(numero: str, mensaje: str, respuesta: str, etiqueta: str = "NochGPT") -> dict:
-    """Envía un ticket a Google Sheets mediante webhook"""
+@lru_cache(maxsize=1)
+def _fmt_ts(sec: int) -> str:
+    """Fecha local "YYYY-MM-DD HH:MM:SS"; se formatea una sola vez por segundo."""
+    return datetime.fromtimestamp(sec).isoformat(sep=" ", timespec="seconds")
+
+# POSTs a Sheets en vuelo al mismo tiempo (el Apps Script es lento)
+_SHEETS_MAX_INFLIGHT = 4
+_SHEETS_TASKS: set[asyncio.Task] = set()
+
+async def send_ticket_to_sheet(numero: str, mensaje: str, respuesta: str, etiqueta: str = "NochGPT") -> dict:
+    """Encola un ticket para Google Sheets (lo envía _sheets_flusher)"""
     if not SHEETS_WEBHOOK_URL:
-        print("⚠️ No se envió ticket: falta SHEET_WEBHOOK / SHEETS_WEBHOOK_URL")
+        log.warning("⚠️ No se envió ticket: falta SHEET_WEBHOOK / SHEETS_WEBHOOK_URL")
         return {"ok": False, "error": "missing_sheet_webhook"}
 
     payload = {
-        "fecha": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "fecha": _fmt_ts(int(time.time())),
         "numero": (numero or ""),
         "mensaje": (mensaje or ""),
         "respuesta": (respuesta or ""),
         "etiqueta": etiqueta,
     }
 
+    if _TICKET_Q is None:
+        # Fuera del ciclo de vida de la app no hay cola ni cliente HTTP
+        log.warning("⚠️ No se envió ticket: la cola de Sheets no está activa")
+        return {"ok": False, "error": "sheets_queue_not_running"}
+    await _TICKET_Q.put(payload)
+    return {"ok": True, "queued": True}
+
+async def _post_tickets(batch: list[dict]) -> dict:
+    """Envía uno o varios tickets en un solo POST al webhook de Sheets"""
+    body = batch[0] if len(batch) == 1 else {"rows": batch}
     try:
-        r = requests.post(SHEETS_WEBHOOK_URL, json=payload, timeout=15)
+        # Apps Script responde el doPost con un 302 a script.googleusercontent.com
+        r = await _post_with_retry(
+            SHEETS_WEBHOOK_URL, headers=_JSON_HEADERS, content=orjson.dumps(body),
+            timeout=15, follow_redirects=True,
+        )
         ok = r.status_code == 200
-        print(f"📨 Ticket a Sheets -> status={r.status_code} ok={ok} resp={r.text[:200]}")
+        log.info("📨 Ticket a Sheets (%d) -> status=%s ok=%s", len(batch), r.status_code, ok)
         
         if not ok:
-            print("Respuesta Sheets completa:", r.text)
+            log.warning("Respuesta Sheets completa: %s", r.text)
         
         return {"ok": ok, "status": r.status_code, "resp": r.text}
     except Exception as e:
-        print("Sheet webhook exception:", e)
+        log.error("Sheet webhook exception: %s", e)
         return {"ok": False, "error": str(e)}
 
+async def _sheets_flusher(q: asyncio.Queue) -> None:
+    """Junta hasta SHEETS_BATCH_MAX tickets (o lo que llegue en SHEETS_FLUSH_MS) y los envía.
+
+    Un None en la cola es la señal de apagado: se envía el lote en curso y termina.
+    """
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(_SHEETS_MAX_INFLIGHT)
+
+    def _done(task: asyncio.Task) -> None:
+        _SHEETS_TASKS.discard(task)
+        slots.release()
+
+    stop = False
+    while not stop:
+        first = await q.get()
+        if first is None:
+            return
+        batch = [first]
+        deadline = loop.time() + SHEETS_FLUSH_MS / 1000
+        while len(batch) < SHEETS_BATCH_MAX:
+            left = deadline - loop.time()
+            if left <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(q.get(), left)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+        # Cada lote sale en su propia tarea; el semáforo limita los POSTs en vuelo
+        await slots.acquire()
+        task = asyncio.create_task(_post_tickets(batch))
+        _SHEETS_TASKS.add(task)
+        task.add_done_callback(_done)
+
+async def _drain_tickets(q: asyncio.Queue) -> None:
+    """Al apagar (con el flusher ya detenido): envía lo que quedó en la cola y espera los POSTs en vuelo"""
+    pending = []
+    while not q.empty():
+        pending.append(q.get_nowait())
+    for i in range(0, len(pending), SHEETS_BATCH_MAX):
+        await _post_tickets(pending[i:i + SHEETS_BATCH_MAX])
+    if _SHEETS_TASKS:
+        await asyncio.gather(*_SHEETS_TASKS, return_exceptions=True)
+
 # -------------------------------------------------------
 # MANEJO DE HISTORIAL
 # -------------------------------------------------------
 def _append_history(q: str, a: str, lang: Optional[str]):
     """Añade una entrada al historial en memoria"""
     try:
-        ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        ts = _fmt_ts(int(time.time()))
         HISTORY_LOG.append(f"[{ts}] ({lang or 'en'})\nQ: {q}\nA: {a}\n")
-        if len(HISTORY_LOG) > 500:
-            del HISTORY_LOG[: len(HISTORY_LOG) - 500]
     except Exception:
         pass
 
+# -------------------------------------------------------
+# REPROCESO POR LOTES (OpenAI Batch API)
+# -------------------------------------------------------
+# Trabajo no urgente (re-responder tickets viejos): va por la Batch API,
+# a mitad de precio y fuera del límite por minuto del tráfico en vivo
+_BATCH_POLL_FIRST = 30      # segundos hasta la primera consulta
+_BATCH_POLL_MAX = 600       # tope del backoff exponencial
+_BATCH_DONE = {"completed", "failed", "expired", "cancelled"}
+# Nos rendimos tras estas consultas fallidas seguidas, o pasado este tiempo
+# (la ventana del Batch API es de 24 h)
+_BATCH_POLL_FAILS = 5
+_BATCH_WAIT_MAX = 25 * 3600
+_BATCH_TASKS: set[asyncio.Task] = set()
+
+async def submit_reprocess_batch(items: list[dict]) -> str:
+    """Sube los tickets como JSONL, crea el lote y deja una tarea esperando el resultado."""
+    lines = []
+    for i, it in enumerate(items):
+        lang = it["idioma"] or detect_lang(it["mensaje"])
+        sys = _system_prompt(lang)
+        lines.append(orjson.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": OPENAI_MODEL,
+                "messages": [
+                    {"role": "system", "content": sys},
+                    {"role": "user", "content": it["mensaje"]},
+                ],
+                "temperature": OPENAI_TEMP,
+            },
+        }))
+    f = await client.files.create(file=("batch.jsonl", b"\n".join(lines), "application/jsonl"), purpose="batch")
+    batch = await client.batches.create(input_file_id=f.id, endpoint="/v1/chat/completions", completion_window="24h")
+    log.info("📦 Lote %s creado con %d tickets", batch.id, len(items))
+
+    task = asyncio.create_task(_wait_reprocess_batch(batch.id, items))
+    _BATCH_TASKS.add(task)
+    task.add_done_callback(_BATCH_TASKS.discard)
+    return batch.id
+
+async def _wait_reprocess_batch(batch_id: str, items: list[dict]) -> None:
+    """Consulta el lote con backoff exponencial y manda las respuestas a Sheets."""
+    delay = _BATCH_POLL_FIRST
+    deadline = time.monotonic() + _BATCH_WAIT_MAX
+    fails = 0
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            batch = await client.batches.retrieve(batch_id)
+            fails = 0
+        except Exception as e:
+            fails += 1
+            log.warning("Consulta del lote %s falló (%d/%d): %s", batch_id, fails, _BATCH_POLL_FAILS, e)
+            batch = None
+        if batch is not None and batch.status in _BATCH_DONE:
+            break
+        if fails >= _BATCH_POLL_FAILS or time.monotonic() >= deadline:
+            log.error("❌ Dejo de consultar el lote %s: sin respuesta final", batch_id)
+            return
+        delay = min(delay * 2, _BATCH_POLL_MAX)
+
+    if batch.status != "completed" or not batch.output_file_id:
+        log.error("❌ Lote %s terminó en estado %s", batch_id, batch.status)
+        return
+
+    out = await client.files.content(batch.output_file_id)
+    sent = 0
+    for line in out.text.splitlines():
+        if not line.strip():
+            continue
+        row = orjson.loads(line)
+        try:
+            it = items[int(row["custom_id"])]
+            answer = row["response"]["body"]["choices"][0]["message"]["content"].strip()
+        except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+            continue
+        await send_ticket_to_sheet(it["numero"], it["mensaje"], answer, etiqueta="NochGPT-batch")
+        sent += 1
+    log.info("📦 Lote %s listo: %d/%d respuestas a Sheets", batch_id, sent, len(items))
+
 # -------------------------------------------------------
 # MODELOS PYDANTIC
 # -------------------------------------------------------
 class ChatIn(BaseModel):
     pregunta: str
     idioma: Optional[str] = None
+    # Solo admin (X-Admin-Token): ignora la caché para probar respuestas frescas
+    sin_cache: bool = False
+
+class TicketIn(BaseModel):
+    mensaje: str
+    numero: str = ""
+    idioma: Optional[str] = None
+
+class BatchIn(BaseModel):
+    items: list[TicketIn]
 
 # -------------------------------------------------------
 # ENDPOINTS PRINCIPALES
@@ -367,23 +1042,74 @@ def health():
     return {"ok": True, "root_path": ROOT_PATH}
 
 @app.post("/chat")
-async def chat_endpoint(body: ChatIn):
+async def chat_endpoint(body: ChatIn, request: Request):
     """Endpoint para chat desde el frontend (Wix)"""
     q = (body.pregunta or "").strip()
     if not q:
         raise HTTPException(status_code=400, detail="Falta 'pregunta'")
     
-    lang = body.idioma or detect_lang(q)
-    ans = call_openai(q, lang_hint=lang)
+    if body.sin_cache:
+        _require_admin(request)
+    lang = body.idioma if body.idioma in LANG_NAME else detect_lang(q)
+    ans = await call_openai(q, lang_hint=lang, use_cache=not body.sin_cache)
     _append_history(q, ans, lang)
     
     return {"respuesta": ans}
 
+@app.post("/chat/stream")
+async def chat_stream_endpoint(body: ChatIn, request: Request):
+    """Igual que /chat, pero la respuesta llega por Server-Sent Events mientras se genera"""
+    q = (body.pregunta or "").strip()
+    if not q:
+        raise HTTPException(status_code=400, detail="Falta 'pregunta'")
+
+    if body.sin_cache:
+        _require_admin(request)
+    lang = body.idioma if body.idioma in LANG_NAME else detect_lang(q)
+
+    async def events():
+        parts = []
+        try:
+            async for piece in stream_openai(q, lang_hint=lang, use_cache=not body.sin_cache):
+                parts.append(piece)
+                yield b"data: " + orjson.dumps({"delta": piece}) + b"\n\n"
+        except Exception:
+            # Respuesta cortada: sin [DONE] ni historial, para que no pase por completa
+            yield b"event: error\ndata: " + orjson.dumps({"error": "stream_interrupted"}) + b"\n\n"
+            return
+        _append_history(q, "".join(parts).strip(), lang)
+        yield b"data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-store"})
+
 @app.get("/history")
 def get_history():
     """Devuelve el historial de conversaciones"""
     return {"history": "\n".join(HISTORY_LOG)}
 
+def _require_admin(request: Request) -> None:
+    # Comparación en tiempo constante (en bytes: compare_digest no acepta str no ASCII)
+    token = request.headers.get("x-admin-token", "")
+    if not ADMIN_TOKEN or not secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="forbidden")
+
+@app.post("/batch_reprocess")
+async def batch_reprocess(body: BatchIn, request: Request):
+    """Re-responde tickets en segundo plano vía Batch API (solo admin)"""
+    _require_admin(request)
+    items = [it.model_dump() for it in body.items if it.mensaje.strip()]
+    if not items:
+        raise HTTPException(status_code=400, detail="Faltan 'items'")
+    batch_id = await submit_reprocess_batch(items)
+    return {"batch_id": batch_id, "items": len(items)}
+
+@app.get("/batch_reprocess/{batch_id}")
+async def batch_reprocess_status(batch_id: str, request: Request):
+    """Estado de un lote enviado con /batch_reprocess (solo admin)"""
+    _require_admin(request)
+    batch = await client.batches.retrieve(batch_id)
+    return {"batch_id": batch.id, "status": batch.status, "counts": batch.request_counts.model_dump() if batch.request_counts else None}
+
 @app.get("/webhook")
 async def verify_webhook(request: Request):
     """Verificación del webhook de WhatsApp"""
@@ -391,7 +1117,7 @@ async def verify_webhook(request: Request):
     token = request.query_params.get("hub.verify_token", "")
     challenge = request.query_params.get("hub.challenge", "")
     
-    print(f"WEBHOOK VERIFY => mode={mode}, token={token}, challenge={challenge}")
+    log.info("WEBHOOK VERIFY => mode=%s, token=%s, challenge=%s", mode, token, challenge)
     
     if mode == "subscribe" and token == META_VERIFY_TOKEN and challenge:
         return PlainTextResponse(content=challenge, status_code=200)
@@ -399,14 +1125,16 @@ async def verify_webhook(request: Request):
     return PlainTextResponse(content="forbidden", status_code=403)
 
 @app.post("/webhook")
-async def webhook_handler(request: Request):
+async def webhook_handler(request: Request, background_tasks: BackgroundTasks):
     """Maneja los mensajes entrantes de WhatsApp"""
     try:
-        data = await request.json()
+        data = orjson.loads(await request.body())
     except Exception:
         return JSONResponse({"received": False, "error": "invalid_json"})
     
-    print("📩 Payload:", json.dumps(data)[:1200], "...")
+    # El volcado del payload solo se arma si LOG_LEVEL=DEBUG
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("📩 Payload: %s ...", orjson.dumps(data)[:1200].decode(errors="ignore"))
     
     try:
         entry = (data.get("entry") or [{}])[0]
@@ -416,42 +1144,136 @@ async def webhook_handler(request: Request):
         
         if not msgs:
             return {"status": "no_message"}
-            
-        msg = msgs[0]
-        from_number = msg.get("from")
-        mtype = msg.get("type")
+
+        msgs = [m for m in msgs if not _seen_message(m.get("id"))]
+        if not msgs:
+            return {"status": "duplicate"}
         
-        if mtype == "text":
-            return _handle_text_message(msg, from_number)
-        if mtype == "audio":
-            return _handle_audio_message(msg, from_number)
-        
-        if from_number:
-            wa_send_text(from_number, "Recibí tu mensaje. Por ahora manejo texto y notas de voz.")
-        return {"status": "other_type"}
+        # Meta solo espera un 200 rápido: OpenAI, WhatsApp y Sheets van en segundo plano
+        background_tasks.add_task(_process_messages, msgs)
+        return {"status": "queued"}
         
     except Exception as e:
-        print("❌ Error webhook:", e)
+        log.error("❌ Error webhook: %s", e)
         return {"status": "error"}
 
 # -------------------------------------------------------
 # FUNCIONES DE MANEJO DE MENSAJES
 # -------------------------------------------------------
-def _handle_text_message(msg: dict, from_number: Optional[str]) -> dict:
+def _seen_message(mid: Optional[str]) -> bool:
+    """True si este ID ya llegó hace menos de _SEEN_TTL segundos (reintento de Meta)."""
+    if not mid:
+        return False
+    now = time.monotonic()
+    exp = _SEEN_IDS.get(mid)
+    if exp is not None and exp > now:
+        return True
+    _SEEN_IDS[mid] = now + _SEEN_TTL
+    _SEEN_IDS.move_to_end(mid)
+    if len(_SEEN_IDS) > _SEEN_MAX:
+        _SEEN_IDS.popitem(last=False)
+    return False
+
+def _is_text(m: dict) -> bool:
+    return m.get("type") == "text" and bool((m.get("text") or {}).get("body", "").strip())
+
+async def _process_messages(msgs: list[dict]) -> None:
+    """Atiende los mensajes de un webhook: remitentes distintos en paralelo, cada uno en orden."""
+    by_from: dict[str, list[dict]] = {}
+    jobs = []
+    for m in msgs:
+        if m.get("from"):
+            by_from.setdefault(m["from"], []).append(m)
+        else:
+            jobs.append(_handle_message(m))
+    jobs.extend(_process_sender(ms) for ms in by_from.values())
+    results = await asyncio.gather(*jobs, return_exceptions=True)
+    for res in results:
+        if isinstance(res, Exception):
+            log.error("❌ Error webhook: %s", res)
+
+async def _process_sender(msgs: list[dict]) -> None:
+    """Mensajes de un mismo usuario en el orden en que llegaron (así salen sus respuestas).
+
+    Textos seguidos van en una sola llamada al modelo; nunca mezclamos usuarios en un prompt.
+    """
+    run: list[dict] = []
+    for m in [*msgs, None]:
+        if m is not None and _is_text(m):
+            run.append(m)
+            continue
+        jobs = []
+        if run:
+            jobs.append(_handle_text_batch(run) if len(run) > 1 else _handle_message(run[0]))
+            run = []
+        if m is not None:
+            jobs.append(_handle_message(m))
+        for job in jobs:
+            try:
+                await job
+            except Exception as e:
+                log.error("❌ Error webhook: %s", e)
+
+async def _handle_message(msg: dict) -> dict:
+    from_number = msg.get("from")
+    mtype = msg.get("type")
+    
+    if mtype == "text":
+        return await _handle_text_message(msg, from_number)
+    if mtype == "audio":
+        return await _handle_audio_message(msg, from_number)
+    
+    if from_number:
+        await wa_send_text(from_number, "Recibí tu mensaje. Por ahora manejo texto y notas de voz.")
+    return {"status": "other_type"}
+
+def _user_lang(from_number: Optional[str], text: str) -> str:
+    """Idioma del mensaje, reutilizando el último del mismo número cuando sigue siendo plausible."""
+    if not from_number:
+        return detect_lang(text)
+    prev = _LANG_BY_USER.get(from_number)
+    if prev:
+        script = _script_lang(text[:_DETECT_MAX_CHARS])
+        # Misma escritura no latina, o respuesta latina corta ("ok", "gracias", "y el precio?")
+        # donde el detector es poco fiable: seguimos en el idioma de la conversación
+        if script == prev or (script is None and prev not in _SCRIPT_LANGS and len(text) < _TRANSLATE_MIN_CHARS):
+            _LANG_BY_USER.move_to_end(from_number)
+            return prev
+    lang = detect_lang(text)
+    _LANG_BY_USER[from_number] = lang
+    _LANG_BY_USER.move_to_end(from_number)
+    if len(_LANG_BY_USER) > _LANG_BY_USER_MAX:
+        _LANG_BY_USER.popitem(last=False)
+    return lang
+
+async def _handle_text_message(msg: dict, from_number: Optional[str]) -> dict:
     user_text = (msg.get("text") or {}).get("body", "").strip()
     if not user_text:
         return {"status": "empty_text"}
     
-    lang = detect_lang(user_text)
-    answer = call_openai(user_text, lang_hint=lang)
-    
+    lang = _user_lang(from_number, user_text)
+    answer = await call_openai(user_text, lang_hint=lang)
+    return await _reply_text(from_number, user_text, lang, answer)
+
+async def _handle_text_batch(msgs: list[dict]) -> list[dict]:
+    items = []
+    for m in msgs:
+        user_text = m["text"]["body"].strip()
+        items.append((user_text, _user_lang(m.get("from"), user_text)))
+    answers = await call_openai_batch(items)
+    # Una tras otra: enviadas a la vez, WhatsApp puede entregarlas en otro orden
+    return [
+        await _reply_text(m.get("from"), q, lang, a) for m, (q, lang), a in zip(msgs, items, answers)
+    ]
+
+async def _reply_text(from_number: Optional[str], user_text: str, lang: str, answer: str) -> dict:
     if from_number:
-        wa_send_text(from_number, answer)
-    send_ticket_to_sheet(from_number, user_text, answer, etiqueta="NochGPT")
-    print(f"🗣️ Texto -> lang={lang} from={from_number}")
+        await wa_send_text(from_number, answer)
+    await send_ticket_to_sheet(from_number, user_text, answer, etiqueta="NochGPT")
+    log.info("🗣️ Texto -> lang=%s from=%s", lang, from_number)
     return {"status": "ok_text"}
 
-def _handle_audio_message(msg: dict, from_number: Optional[str]) -> dict:
+async def _handle_audio_message(msg: dict, from_number: Optional[str]) -> dict:
     if not from_number:
         return {"status": "audio_no_number"}
     
@@ -461,35 +1283,33 @@ def _handle_audio_message(msg: dict, from_number: Optional[str]) -> dict:
         return {"status": "audio_no_id"}
     
     try:
-        url = wa_get_media_url(media_id)
-        path, mime = wa_download_media(url)
-        print(f"🎧 Audio guardado en {path} ({mime})")
+        url = await wa_get_media_url(media_id)
+        audio, mime = await wa_download_media(url)
+        log.info("🎧 Audio recibido: %d bytes (%s)", len(audio), mime)
         
-        transcript = transcribe_audio_with_openai(path)
+        transcript = await transcribe_audio_with_openai(audio, mime)
         if not transcript:
-            wa_send_text(from_number, "🎧 Recibí tu audio pero no pude transcribirlo. ¿Puedes intentar otra vez?")
+            await wa_send_text(from_number, "🎧 Recibí tu audio pero no pude transcribirlo. ¿Puedes intentar otra vez?")
             return {"status": "audio_no_transcript"}
         
-        lang = detect_lang(transcript)
-        answer = call_openai(
+        lang = _user_lang(from_number, transcript)
+        answer = await call_openai(
             f"Transcripción del audio del usuario:\n\"\"\"{transcript}\"\"\"",
             lang_hint=lang
         )
         
-        wa_send_text(from_number, f"🗣️ *Transcripción*:\n{transcript}\n\n💬 *Respuesta*:\n{answer}")
-        send_ticket_to_sheet(from_number, transcript, answer, etiqueta="NochGPT")
+        await wa_send_text(from_number, f"🗣️ *Transcripción*:\n{transcript}\n\n💬 *Respuesta*:\n{answer}")
+        await send_ticket_to_sheet(from_number, transcript, answer, etiqueta="NochGPT")
         
-        print(f"🎧 Audio -> lang={lang} from={from_number}")
+        log.info("🎧 Audio -> lang=%s from=%s", lang, from_number)
         return {"status": "ok_audio"}
         
     except Exception as e:
-        print("Audio error:", e)
+        log.error("Audio error: %s", e)
         if from_number:
-            wa_send_text(from_number, "No pude procesar el audio. Intenta nuevamente, por favor.")
+            await wa_send_text(from_number, "No pude procesar el audio. Intenta nuevamente, por favor.")
         return {"status": "audio_error"}
 
-from fastapi.responses import HTMLResponse
-
 WIDGET_HTML_MIN = """
 <!doctype html>
 <html lang="es">
@@ -541,6 +1361,14 @@ WIDGET_HTML_MIN = """
 </html>
 """
 
+# El widget es constante: lo codificamos y comprimimos una sola vez al importar
+_WIDGET_BYTES = WIDGET_HTML_MIN.encode("utf-8")
+_WIDGET_GZ = gzip.compress(_WIDGET_BYTES, compresslevel=9)
+
 @app.get("/widget", response_class=HTMLResponse)
-def widget_min():
-    return HTMLResponse(WIDGET_HTML_MIN, status_code=200, headers={"Cache-Control": "no-store"})
+def widget_min(request: Request):
+    headers = {"Cache-Control": "no-store", "Vary": "Accept-Encoding"}
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return HTMLResponse(_WIDGET_GZ, status_code=200, headers=headers)
+    return HTMLResponse(_WIDGET_BYTES, status_code=200, headers=headers)
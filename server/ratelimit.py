@@ -0,0 +1,47 @@
+
+# ratelimit.py
+# Cubeta de fichas (token bucket) para no pasarnos de los límites por minuto
+# de OpenAI: peticiones (RPM) y tokens (TPM). 0 = sin límite.
+import time, asyncio
+
+class AsyncRateLimiter:
+    """Espera lo justo para que las llamadas no superen rpm/tpm."""
+
+    def __init__(self, rpm: int = 0, tpm: int = 0):
+        self.rpm = max(0, rpm)
+        self.tpm = max(0, tpm)
+        # Empezamos con la cubeta llena (permite una ráfaga de hasta un minuto de cupo)
+        self._req = float(self.rpm)
+        self._tok = float(self.tpm)
+        self._last = time.monotonic()
+        # Un solo turno a la vez: quien llega primero, sale primero
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last
+        self._last = now
+        if self.rpm:
+            self._req = min(self.rpm, self._req + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tok = min(self.tpm, self._tok + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens: int = 0):
+        """Toma una petición y `tokens` fichas; duerme hasta que haya cupo."""
+        if not (self.rpm or self.tpm):
+            return
+        # Una llamada más grande que el cupo completo nunca cabría: la limitamos al máximo
+        tokens = min(tokens, self.tpm) if self.tpm else 0
+        async with self._lock:
+            while True:
+                self._refill()
+                wait_req = max(0.0, 1 - self._req) * 60 / self.rpm if self.rpm else 0.0
+                wait_tok = max(0.0, tokens - self._tok) * 60 / self.tpm if self.tpm else 0.0
+                wait = max(wait_req, wait_tok)
+                if wait <= 0:
+                    if self.rpm:
+                        self._req -= 1
+                    if self.tpm:
+                        self._tok -= tokens
+                    return
+                await asyncio.sleep(wait)
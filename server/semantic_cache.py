@@ -0,0 +1,81 @@
+
+# semantic_cache.py
+# Caja "por significado": si una pregunta nueva se parece mucho a una ya
+# respondida (mismo idioma), devolvemos esa respuesta sin llamar al modelo.
+import os, threading
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# Apagada por defecto: cada pregunta nueva cuesta una llamada de embeddings
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "0") == "1" and NUMPY_AVAILABLE
+SEMANTIC_MODEL = os.getenv("SEMANTIC_MODEL", "text-embedding-3-small")
+# Similitud coseno mínima para considerar dos preguntas "la misma"
+SEMANTIC_MIN_SCORE = float(os.getenv("SEMANTIC_MIN_SCORE", "0.92"))
+# Máximo de preguntas guardadas; al llenarse pisamos la más vieja.
+# Memoria: 6 KB por pregunta con el modelo por defecto (1536 floats), ~61 MB por
+# worker con las 10000 llenas. La matriz crece a medida que llegan preguntas
+SEMANTIC_MAX = int(os.getenv("SEMANTIC_MAX", "10000"))
+
+# Filas con las que arranca la matriz (luego se duplica hasta SEMANTIC_MAX)
+_INITIAL_ROWS = 256
+
+_lock = threading.Lock()
+_vecs = None            # matriz (capacidad, dim) de vectores normalizados
+_lang_ids = None        # id de idioma de cada fila (ver _LANG_IDS)
+_LANG_IDS: dict = {}    # idioma -> id
+_answers: list = []     # respuesta de cada fila
+_next = 0               # próxima fila a escribir (anillo)
+
+def _unit(emb):
+    """Vector float32 de norma 1 (así el producto punto es el coseno)."""
+    v = np.asarray(emb, dtype=np.float32)
+    n = float(np.linalg.norm(v))
+    return v / n if n else v
+
+def semantic_get(emb, lang: str):
+    """Busca la respuesta más parecida en el mismo idioma; None si no alcanza el umbral."""
+    v = _unit(emb)
+    with _lock:
+        lid = _LANG_IDS.get(lang)
+        if lid is None or not _answers:
+            return None
+        n = len(_answers)
+        scores = _vecs[:n] @ v
+        # Solo compiten preguntas del mismo idioma
+        scores[_lang_ids[:n] != lid] = -np.inf
+        i = int(np.argmax(scores))
+        if scores[i] < SEMANTIC_MIN_SCORE:
+            return None
+        return _answers[i]
+
+def _grow(dim: int) -> None:
+    """Duplica la capacidad de la matriz (sin pasar de SEMANTIC_MAX)."""
+    global _vecs, _lang_ids
+    rows = _INITIAL_ROWS if _vecs is None else _vecs.shape[0] * 2
+    rows = min(rows, SEMANTIC_MAX)
+    vecs = np.zeros((rows, dim), dtype=np.float32)
+    ids = np.zeros(rows, dtype=np.int32)
+    if _vecs is not None:
+        vecs[:_vecs.shape[0]] = _vecs
+        ids[:_lang_ids.shape[0]] = _lang_ids
+    _vecs, _lang_ids = vecs, ids
+
+def semantic_put(emb, lang: str, respuesta: str):
+    """Guarda el vector de la pregunta junto a su respuesta."""
+    global _next
+    v = _unit(emb)
+    with _lock:
+        i = _next
+        if _vecs is None or i >= _vecs.shape[0]:
+            _grow(v.shape[0])
+        _vecs[i] = v
+        _lang_ids[i] = _LANG_IDS.setdefault(lang, len(_LANG_IDS))
+        if i < len(_answers):
+            _answers[i] = respuesta
+        else:
+            _answers.append(respuesta)
+        _next = (i + 1) % SEMANTIC_MAX